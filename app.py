@@ -1,9 +1,11 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import altair as alt
+import io
 import os
 from settings import DefaultSettings
-from compute import compute_kpis, load_app_config
+from compute import prepare_events, compute_kpis_from_events, load_app_config, timing_run
 from ui import sidebar_settings, filters
 
 st.set_page_config(page_title="Agent Productivity Tracker (Debug Mode)", layout="wide")
@@ -28,31 +30,79 @@ settings.default_shift_end = default_end
 settings.overlap_rule = overlap_rule
 settings.timezone = tz_name
 
-def read_csv_or_sample(file, sample_path, label):
+team_field = "team"
+
+def read_csv_columns(source, columns, date_cols, chunksize=None, text_cols=()):
+    # Multithreaded PyArrow reader; only the columns the pipeline uses, timestamps parsed at read time
+    header = pd.read_csv(source, nrows=0).columns
+    if hasattr(source, "seek"):
+        source.seek(0)
+    usecols = [c for c in header if c in columns]
+    parse_dates = [c for c in date_cols if c in header]
+    # Label columns stay in Arrow string buffers (no per-value Python str objects) until they become categoricals
+    dtype = {c: "string[pyarrow]" for c in text_cols if c in usecols}
+    if chunksize:
+        # The pyarrow engine cannot stream, so large files go through the C parser chunk by chunk
+        return pd.read_csv(source, usecols=usecols, parse_dates=parse_dates, dtype=dtype, chunksize=chunksize)
+    return pd.read_csv(source, engine="pyarrow", usecols=usecols, parse_dates=parse_dates, dtype=dtype)
+
+def read_bytes_or_sample(file, sample_path, label):
     if file is not None:
         st.write(f"✅ Loaded {label}: {file.name}")
-        return pd.read_csv(file)
+        return file.getvalue()
     st.write(f"⚠️ Using sample {label}: {sample_path}")
-    return pd.read_csv(sample_path)
+    with open(sample_path, "rb") as f:
+        return f.read()
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def cached_events(tickets_bytes, calls_bytes, tz_name, team_field, chunk_rows, chunk_threshold_bytes):
+    # Keyed on the raw CSV bytes: parsing, normalization and category mapping rerun only for new uploads
+    s = DefaultSettings(timezone=tz_name)
+    chunks_for = lambda b: chunk_rows if len(b) > chunk_threshold_bytes else None
+    df_t = read_csv_columns(io.BytesIO(tickets_bytes), list(s.ticket_columns.values()) + [team_field],
+                            [s.ticket_columns["start_ts"], s.ticket_columns["end_ts"]], chunks_for(tickets_bytes),
+                            [s.ticket_columns[k] for k in ("agent","ticket_id","category")] + [team_field])
+    df_c = read_csv_columns(io.BytesIO(calls_bytes), list(s.call_columns.values()) + [team_field],
+                            [s.call_columns["start_ts"], s.call_columns["end_ts"]], chunks_for(calls_bytes),
+                            [s.call_columns[k] for k in ("agent","call_id","category")] + [team_field])
+    return prepare_events(df_t, df_c, s, tz_name, team_field=team_field)
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def cached_kpis(tickets_bytes, calls_bytes, sched_bytes, shift_start, shift_end, overlap_rule, tz_name, team_field,
+                chunk_rows, chunk_threshold_bytes, groupby_engine):
+    # Keyed on the raw CSV bytes + settings: reruns with unchanged inputs (e.g. filter edits) skip the pipeline,
+    # and shift/overlap changes reuse the cached event table
+    # One timing run spans both stages: a cached event table simply contributes no event-stage rows
+    with timing_run():
+        events = cached_events(tickets_bytes, calls_bytes, tz_name, team_field, chunk_rows, chunk_threshold_bytes)
+        s = DefaultSettings(default_shift_start=shift_start, default_shift_end=shift_end,
+                            overlap_rule=overlap_rule, timezone=tz_name, groupby_engine=groupby_engine)
+        df_s = None
+        if sched_bytes is not None:
+            df_s = read_csv_columns(io.BytesIO(sched_bytes), list(s.schedule_columns.values()) + [team_field],
+                                    [s.schedule_columns["date"]],
+                                    text_cols=[s.schedule_columns[k] for k in ("agent","shift_start","shift_end")] + [team_field])
+        return compute_kpis_from_events(events, df_s, s, tz_name, team_field=team_field)
 
 # Load data
 st.write("🔄 Loading data files...")
-df_tickets = read_csv_or_sample(tickets_file, "sample_data/tickets_sample.csv", "Tickets")
-df_calls = read_csv_or_sample(calls_file, "sample_data/calls_sample.csv", "Calls")
-df_schedule = None
+tickets_bytes = read_bytes_or_sample(tickets_file, "sample_data/tickets_sample.csv", "Tickets")
+calls_bytes = read_bytes_or_sample(calls_file, "sample_data/calls_sample.csv", "Calls")
+sched_bytes = None
 if sched_file is not None:
     st.write(f"✅ Loaded Schedule: {sched_file.name}")
-    df_schedule = pd.read_csv(sched_file)
+    sched_bytes = sched_file.getvalue()
 else:
     st.write("⚠️ No schedule uploaded, using default 09:00–18:00 shifts")
 
-team_field = "team"
-
 # Compute KPIs
 st.write("🚀 Starting KPI computation...")
 try:
-    daily, cat_aht, heatmap = compute_kpis(
-        df_tickets, df_calls, df_schedule, settings, tz_name, team_field=team_field
+    daily, cat_aht, heatmap = cached_kpis(
+        tickets_bytes, calls_bytes, sched_bytes,
+        settings.default_shift_start, settings.default_shift_end, settings.overlap_rule, tz_name, team_field,
+        int(app_cfg.get("csv_chunk_rows", 500_000)), int(app_cfg.get("csv_chunk_threshold_mb", 200)) * 1024 * 1024,
+        app_cfg.get("groupby_engine")
     )
     st.success("✅ KPI computation complete")
 except Exception as e:
@@ -63,19 +113,22 @@ except Exception as e:
 st.write("🔄 Applying filters...")
 sel_agents, sel_teams, date_range = filters(daily)
 
-def apply_filters(df):
-    dfx = df.copy()
-    if sel_agents:
-        dfx = dfx[dfx["agent"].isin(sel_agents)]
-    if sel_teams:
-        dfx = dfx[dfx["team"].isin(sel_teams)]
+@st.cache_data(show_spinner=False)
+def apply_filters(df, agents, teams, date_range):
+    # One boolean mask composed in NumPy, one take; repeated selections come from the cache
+    mask = np.ones(len(df), dtype=bool)
+    if agents:
+        mask &= df["agent"].isin(agents).values
+    if teams:
+        mask &= df["team"].isin(teams).values
     if isinstance(date_range, tuple) and len(date_range) == 2 and all(date_range):
         start_d, end_d = date_range
-        dfx = dfx[(dfx["date"] >= start_d) & (dfx["date"] <= end_d)]
-    return dfx
+        d = df["date"].values.astype("datetime64[D]")
+        mask &= (d >= np.datetime64(start_d, "D")) & (d <= np.datetime64(end_d, "D"))
+    return df[mask]
 
-daily_f = apply_filters(daily)
-heatmap_f = apply_filters(heatmap)
+daily_f = apply_filters(daily, sel_agents, sel_teams, date_range)
+heatmap_f = apply_filters(heatmap, sel_agents, sel_teams, date_range)
 st.success("✅ Filters applied")
 
 # KPI section
@@ -83,25 +136,33 @@ st.subheader("Per-agent summary (Debug)")
 if daily_f.empty:
     st.info("ℹ️ No data after filters.")
 else:
-    st.write(f"📊 Rendering KPIs for {len(daily_f['agent'].unique())} agents")
+    # One groupby for all agents instead of a mask + sums per agent
+    agg = daily_f.groupby("agent", observed=True, sort=False)[
+        ["productive_seconds","scheduled_seconds","idle_seconds"]
+    ].sum().sort_index()
+    # Hour/minute parts computed column-wise once, not per metric in the render loop
+    for col, key in (("productive_seconds", "prod"), ("scheduled_seconds", "sched"), ("idle_seconds", "idle")):
+        agg[f"{key}_h"] = (agg[col] // 3600).astype(int)
+        agg[f"{key}_m"] = ((agg[col] % 3600) // 60).astype(int)
+    sched = agg["scheduled_seconds"].to_numpy(dtype=float)
+    agg["util"] = np.divide(100 * agg["productive_seconds"].to_numpy(dtype=float), sched,
+                            out=np.zeros(len(agg)), where=sched > 0)
+    st.write(f"📊 Rendering KPIs for {len(agg)} agents")
     kpi_cols = st.columns(4)
-    for i, agent in enumerate(sorted(daily_f["agent"].unique())):
-        agent_df = daily_f[daily_f["agent"] == agent]
-        prod = agent_df["productive_seconds"].sum()
-        sched = agent_df["scheduled_seconds"].sum()
-        idle = agent_df["idle_seconds"].sum()
-        util = (100 * prod / sched) if sched > 0 else 0
+    for i, row in enumerate(agg.itertuples()):
+        agent = row.Index
         with kpi_cols[i % 4]:
-            st.metric(label=f"{agent} • Productive time", value=f"{int(prod//3600)}h {int((prod%3600)//60)}m")
-            st.metric(label=f"{agent} • Scheduled time", value=f"{int(sched//3600)}h {int((sched%3600)//60)}m")
-            st.metric(label=f"{agent} • Utilization %", value=f"{util:.1f}%")
-            st.metric(label=f"{agent} • Idle time", value=f"{int(idle//3600)}h {int((idle%3600)//60)}m")
+            st.metric(label=f"{agent} • Productive time", value=f"{row.prod_h}h {row.prod_m}m")
+            st.metric(label=f"{agent} • Scheduled time", value=f"{row.sched_h}h {row.sched_m}m")
+            st.metric(label=f"{agent} • Utilization %", value=f"{row.util:.1f}%")
+            st.metric(label=f"{agent} • Idle time", value=f"{row.idle_h}h {row.idle_m}m")
 
 # Heatmap
 st.subheader("Team view: busiest hours heatmap (Debug)")
 if not heatmap_f.empty:
     st.write(f"📊 Rendering heatmap for {heatmap_f['date'].nunique()} days")
-    heatmap_f["date_str"] = heatmap_f["date"].astype(str)
+    heatmap_f = heatmap_f.groupby(["date","hour","team"], dropna=False, observed=True, sort=False)["productive_seconds"].sum().reset_index()
+    heatmap_f["date_str"] = pd.to_datetime(heatmap_f["date"]).dt.strftime("%Y-%m-%d")
     heat = alt.Chart(heatmap_f).mark_rect().encode(
         x=alt.X("hour:O", title="Hour of day"),
         y=alt.Y("date_str:O", title="Date"),
@@ -116,7 +177,7 @@ else:
 st.subheader("Average handling time by category (Debug)")
 if not cat_aht.empty:
     st.write(f"📊 Rendering {len(cat_aht)} category averages")
-    cat_view = cat_aht.copy()
+    cat_view = cat_aht.copy(deep=False)
     cat_view["avg_handle_minutes"] = (cat_view["avg_handle_seconds"] / 60).round(1)
     st.dataframe(cat_view[["category_mapped","source","avg_handle_minutes"]], use_container_width=True)
 else:
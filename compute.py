@@ -1,121 +1,355 @@
 import pandas as pd
 import numpy as np
 import time
+import logging
+import warnings
+import os, copy
+import contextvars
+from contextlib import contextmanager
 import json, yaml
+from collections import OrderedDict
 import streamlit as st   # 👈 added so we can write timings to UI
 from settings import DefaultSettings
 
+# libyaml's C parser when PyYAML was built against it; the pure-Python SafeLoader otherwise
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:  # numba is optional; split_time falls back to the NumPy sweep
+    HAVE_NUMBA = False
+
+log = logging.getLogger("compute")
+# Stage timings of the current pipeline run. A ContextVar keeps concurrent Streamlit sessions
+# (one script thread each) from reading or mixing each other's entries
+_run_timings = contextvars.ContextVar("compute_timings", default=None)
+
+@contextmanager
+def timing_run():
+    token = _run_timings.set({})
+    try:
+        yield _run_timings.get()
+    finally:
+        _run_timings.reset(token)
+
+def _record(step, rows, t0):
+    # Per-stage totals (parse_datetimes etc. run per frame/chunk); shown once by compute_kpis_from_events
+    elapsed = time.time() - t0
+    timings = _run_timings.get()
+    if timings is not None:
+        entry = timings.setdefault(step, {"rows": 0, "seconds": 0.0})
+        entry["rows"] += rows
+        entry["seconds"] += elapsed
+    log.debug("%s: %d rows in %.2fs", step, rows, elapsed)
+
 # ---------- Config loaders ----------
-def load_category_mapping(path: str):
+# Parsed configs keyed by (path, parser), invalidated by mtime+size: Streamlit reruns the script on
+# every interaction, so repeat loads skip the parse but still pick up edits to the files
+_config_cache = OrderedDict()
+_CONFIG_CACHE_MAX = 100
+
+def _load_cached(path, parse):
+    stat = os.stat(path)
+    key = (path, parse)
+    hit = _config_cache.get(key)
+    if hit is not None and hit[:2] == (stat.st_mtime, stat.st_size):
+        _config_cache.move_to_end(key)
+        return copy.deepcopy(hit[2])
+    with open(path, "r") as f:
+        content = parse(f)
+    _config_cache[key] = (stat.st_mtime, stat.st_size, content)
+    _config_cache.move_to_end(key)
+    if len(_config_cache) > _CONFIG_CACHE_MAX:
+        _config_cache.popitem(last=False)
+    # Callers get their own copy so mutating a result can't poison the cache
+    return copy.deepcopy(content)
+
+def _parse_category_mapping(f):
+    # The inverse (lowercased raw label -> canonical label) is built once per parse and cached with it
+    mapping = json.load(f)
+    return mapping, {str(v).lower(): k for k, vs in mapping.items() for v in vs}
+
+def load_category_mappings(path: str):
     try:
-        with open(path, "r") as f:
-            return json.load(f)
+        return _load_cached(path, _parse_category_mapping)
     except Exception as e:
         st.write(f"[compute] Failed to load category mapping: {e}")
-        return {"Other": []}
+        return {"Other": []}, {}
+
+def load_category_mapping(path: str):
+    return load_category_mappings(path)[0]
+
+def load_category_reverse_map(path: str):
+    return load_category_mappings(path)[1]
+
+def _parse_yaml(f):
+    return yaml.load(f, Loader=_YamlLoader)
 
 def load_app_config(path: str):
     try:
-        with open(path, "r") as f:
-            return yaml.safe_load(f)
+        return _load_cached(path, _parse_yaml)
     except Exception as e:
         st.write(f"[compute] Failed to load app config: {e}")
         return {}
 
 # ---------- Normalization helpers ----------
-def parse_datetimes(df, start_col, end_col, tz_name):
+def _to_datetime(ts, ts_format, epoch_unit, tz_name):
+    # Columns parsed at read time (app.py's pyarrow reader) skip the second parse
+    if pd.api.types.is_datetime64_any_dtype(ts):
+        return ts
+    # Epoch numbers are UTC instants: no string parsing at all
+    if pd.api.types.is_numeric_dtype(ts):
+        return pd.to_datetime(ts, unit=epoch_unit, utc=True, errors="coerce").dt.tz_convert(tz_name)
+    parsed = _parse_strings(ts, ts_format, tz_name)
+    if ts_format is not None:
+        failed = (parsed.isna() & ts.notna()).to_numpy()
+        if failed.any():
+            # Values off the pinned format (e.g. "11/10/2025 09:15") get the old inferring parse
+            retry = _parse_strings(ts[failed], None, tz_name)
+            values = parsed.dt.as_unit("ns").array.copy()
+            values[failed] = retry.dt.as_unit("ns").array
+            parsed = pd.Series(values, index=ts.index, name=ts.name)
+    return parsed
+
+def _parse_strings(ts, ts_format, tz_name):
+    # An explicit format (ISO8601 by default) takes the C parser instead of per-value inference
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", FutureWarning)  # mixed-offset notice; handled below
+        try:
+            parsed = pd.to_datetime(ts, format=ts_format, errors="coerce")
+        except ValueError:
+            parsed = None
+    if parsed is None or not pd.api.types.is_datetime64_any_dtype(parsed):
+        # Strings with mixed UTC offsets: parse as instants, then show them in the app timezone
+        return pd.to_datetime(ts, format=ts_format, utc=True, errors="coerce").dt.tz_convert(tz_name)
+    if parsed.dt.tz is None:
+        return parsed.dt.tz_localize(tz_name, ambiguous="NaT", nonexistent="NaT")
+    return parsed.dt.tz_convert(tz_name)
+
+def parse_datetimes(df, start_col, end_col, tz_name, ts_format="ISO8601", epoch_unit="s"):
     t0 = time.time()
-    df = df.copy()
-    df[start_col] = pd.to_datetime(df[start_col], errors="coerce")
-    df[end_col] = pd.to_datetime(df[end_col], errors="coerce")
-    df = df.dropna(subset=[start_col, end_col])
-    try:
-        if getattr(df[start_col].dt, "tz", None) is None:
-            df[start_col] = df[start_col].dt.tz_localize(tz_name, errors="coerce")
-        if getattr(df[end_col].dt, "tz", None) is None:
-            df[end_col] = df[end_col].dt.tz_localize(tz_name, errors="coerce")
-    except Exception as e:
-        st.write(f"[compute] tz_localize error: {e}")
-    st.write(f"⏱ parse_datetimes: {len(df)} rows in {time.time()-t0:.2f}s")
+    parsed = []
+    for col in (start_col, end_col):
+        ts = _to_datetime(df[col], ts_format, epoch_unit, tz_name)
+        try:
+            if getattr(ts.dt, "tz", None) is None:
+                ts = ts.dt.tz_localize(tz_name, ambiguous="NaT", nonexistent="NaT")
+        except Exception as e:
+            st.write(f"[compute] tz_localize error: {e}")
+        parsed.append(ts)
+    start, end = parsed
+    # Masked after localization so ambiguous/nonexistent local times go too; only the two
+    # timestamp columns are rebuilt, the other columns are shared or taken once
+    mask = (start.notna() & end.notna()).to_numpy()
+    if mask.all():
+        df = df.copy(deep=False)
+    else:
+        st.write(f"⚠️ {int((~mask).sum())} rows with missing or unparseable {start_col}/{end_col} were skipped")
+        keep = np.flatnonzero(mask)
+        df = df.take(keep)
+        start, end = start.take(keep), end.take(keep)
+    df[start_col] = start
+    df[end_col] = end
+    _record("parse_datetimes", len(df), t0)
     return df
 
+NS_PER_HOUR = 3_600_000_000_000
+NS_PER_DAY = 24 * NS_PER_HOUR
+
+def _utc_ns(ts):
+    """UTC int64 nanoseconds for a timestamp column, whatever its tz mix or datetime64 unit."""
+    return pd.to_datetime(ts, utc=True).dt.as_unit("ns").values.view("i8")
+
+def _duration_seconds(df, start_col, end_col):
+    # Single int64 pass over the (UTC) nanosecond buffers instead of timedelta64 -> total_seconds()
+    dur = (_utc_ns(df[end_col]) - _utc_ns(df[start_col])) * 1e-9
+    np.clip(dur, 0, None, out=dur)
+    return dur
+
+def _normalize_chunks(chunks, normalize, settings, tz_name):
+    # Chunked input (pd.read_csv(..., chunksize=...)): only one raw chunk is alive at a time
+    parts = [normalize(chunk, settings, tz_name) for chunk in chunks]
+    return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+
 def normalize_calls(df_calls, settings, tz_name):
+    if not isinstance(df_calls, pd.DataFrame):
+        return _normalize_chunks(df_calls, normalize_calls, settings, tz_name)
     t0 = time.time()
-    df = parse_datetimes(df_calls, settings.call_columns["start_ts"], settings.call_columns["end_ts"], tz_name)
+    df = parse_datetimes(df_calls, settings.call_columns["start_ts"], settings.call_columns["end_ts"], tz_name,
+                         settings.ts_format, settings.epoch_unit)
     dur_col = settings.call_columns["duration_seconds"]
     if dur_col not in df.columns:
-        df[dur_col] = (df[settings.call_columns["end_ts"]] - df[settings.call_columns["start_ts"]]).dt.total_seconds()
-    df[dur_col] = df[dur_col].fillna(0).clip(lower=0)
-    st.write(f"⏱ normalize_calls: {len(df)} rows in {time.time()-t0:.2f}s")
+        df[dur_col] = _duration_seconds(df, settings.call_columns["start_ts"], settings.call_columns["end_ts"])
+    else:
+        df[dur_col] = df[dur_col].fillna(0).clip(lower=0)
+    df[dur_col] = pd.to_numeric(df[dur_col], downcast="float")
+    _record("normalize_calls", len(df), t0)
     return df
 
 def normalize_tickets(df_tickets, settings, tz_name):
+    if not isinstance(df_tickets, pd.DataFrame):
+        return _normalize_chunks(df_tickets, normalize_tickets, settings, tz_name)
     t0 = time.time()
-    df = parse_datetimes(df_tickets, settings.ticket_columns["start_ts"], settings.ticket_columns["end_ts"], tz_name)
-    df["duration_seconds"] = (df[settings.ticket_columns["end_ts"]] - df[settings.ticket_columns["start_ts"]]).dt.total_seconds()
-    df["duration_seconds"] = df["duration_seconds"].fillna(0).clip(lower=0)
-    st.write(f"⏱ normalize_tickets: {len(df)} rows in {time.time()-t0:.2f}s")
+    df = parse_datetimes(df_tickets, settings.ticket_columns["start_ts"], settings.ticket_columns["end_ts"], tz_name,
+                         settings.ts_format, settings.epoch_unit)
+    df["duration_seconds"] = pd.to_numeric(
+        _duration_seconds(df, settings.ticket_columns["start_ts"], settings.ticket_columns["end_ts"]), downcast="float")
+    _record("normalize_tickets", len(df), t0)
     return df
 
 def normalize_schedule(df_sched, settings):
     t0 = time.time()
-    df = df_sched.copy()
+    df = df_sched.copy(deep=False)
     df[settings.schedule_columns["date"]] = pd.to_datetime(df[settings.schedule_columns["date"]], errors="coerce").dt.date
-    st.write(f"⏱ normalize_schedule: {len(df)} rows in {time.time()-t0:.2f}s")
+    _record("normalize_schedule", len(df), t0)
     return df
 
 # ---------- Category mapping ----------
-def apply_category_mapping(df, category_col, mapping):
+def apply_category_mapping(df, category_col, mapping, reverse_map=None):
+    t0 = time.time()
+    if reverse_map is None:
+        reverse_map = {str(v).lower(): k for k, vs in mapping.items() for v in vs}
+    # Fixed category set (mapping keys + "Other"): the column is int8 codes and groups the same on every run
+    categories = pd.Index(list(dict.fromkeys([*mapping.keys(), "Other"])))
+    # Map each distinct raw label once; rows then only index a code -> code lookup table
+    raw = df[category_col].astype("category")
+    labels = raw.cat.categories
+    mapped = pd.Series(labels.astype(str).str.lower()).map(reverse_map)
+    # Labels already in canonical form (e.g. "Incidents") pass through unchanged
+    fallback = pd.Series(labels.where(labels.isin(categories), "Other"))
+    # Trailing "Other" slot: missing labels (code -1) index it directly, even when every label is missing
+    lut = np.append(categories.get_indexer(mapped.fillna(fallback)), categories.get_loc("Other"))
+    df["category_mapped"] = pd.Categorical.from_codes(lut[raw.cat.codes.to_numpy()], categories=categories)
+    _record("apply_category_mapping", len(df), t0)
+    return df
+
+# ---------- Schedule ----------
+def build_default_schedule(agents, dates, team_series, start_t, end_t, settings):
     t0 = time.time()
-    reverse_map = {str(v).lower(): k for k, vs in mapping.items() for v in vs}
-    def map_fn(x):
-        if pd.isna(x):
-            return "Other"
-        return reverse_map.get(str(x).lower(), "Other")
-    df["category_mapped"] = df[category_col].apply(map_fn)
-    st.write(f"⏱ apply_category_mapping: {len(df)} rows in {time.time()-t0:.2f}s")
+    cols = settings.schedule_columns
+    agents_u = pd.Index(agents.dropna().unique())
+    dates_u = pd.Index(pd.Series(dates).dropna().unique())
+    idx = pd.MultiIndex.from_product([agents_u, dates_u], names=[cols["agent"], cols["date"]])
+    df = idx.to_frame(index=False)
+    df[cols["shift_start"]] = start_t.strftime("%H:%M")
+    df[cols["shift_end"]] = end_t.strftime("%H:%M")
+    if team_series is not None:
+        team_map = (pd.DataFrame({"a": agents, "t": team_series}).dropna()
+                    .drop_duplicates("a").set_index("a")["t"])
+        df["team"] = df[cols["agent"]].map(team_map)
+    else:
+        df["team"] = None
+    _record("build_default_schedule", len(df), t0)
     return df
 
 # ---------- Overlap adjustment ----------
+def _split_time_alloc(starts, ends):
+    """Sweep-line split of overlapping [start, end) windows (int64 ns) -> seconds per window."""
+    boundaries = np.unique(np.concatenate([starts, ends]))
+    lo = np.searchsorted(boundaries, starts)
+    hi = np.maximum(np.searchsorted(boundaries, ends), lo)
+    n = len(boundaries)
+    active = np.cumsum(np.bincount(lo, minlength=n) - np.bincount(hi, minlength=n))[:-1]
+    seg_lens = np.diff(boundaries) * 1e-9
+    share = np.divide(seg_lens, active, out=np.zeros(len(seg_lens)), where=active > 0)
+    ps = np.concatenate([[0.0], np.cumsum(share)])
+    return ps[hi] - ps[lo]
+
+if HAVE_NUMBA:
+    @njit(nogil=True, cache=True)
+    def _split_time_kernel(starts, ends, offsets):
+        """Same sweep as _split_time_alloc, run for every agent block [offsets[g], offsets[g+1])."""
+        alloc = np.zeros(len(starts))
+        for g in range(len(offsets) - 1):
+            lo, hi = offsets[g], offsets[g + 1]
+            s = starts[lo:hi]
+            e = ends[lo:hi]
+            boundaries = np.unique(np.concatenate((s, e)))
+            first = np.searchsorted(boundaries, s)
+            last = np.maximum(np.searchsorted(boundaries, e), first)
+            delta = np.zeros(len(boundaries), dtype=np.int64)
+            for i in range(hi - lo):
+                delta[first[i]] += 1
+                delta[last[i]] -= 1
+            ps = np.zeros(len(boundaries))
+            active = 0
+            acc = 0.0
+            for j in range(len(boundaries) - 1):
+                active += delta[j]
+                if active > 0:
+                    acc += (boundaries[j + 1] - boundaries[j]) * 1e-9 / active
+                ps[j + 1] = acc
+            for i in range(hi - lo):
+                alloc[lo + i] = ps[last[i]] - ps[first[i]]
+        return alloc
+
 def overlap_adjust(events, rule):
     t0 = time.time()
-    out = []
-    for agent, group in events.groupby("agent"):
-        g = group.sort_values("start_ts").reset_index(drop=True)
-        if rule == "count_full":
-            g["productive_seconds"] = g["duration_seconds"].clip(lower=0)
-            out.append(g)
-            continue
-        boundaries = sorted(set(list(g["start_ts"].dropna()) + list(g["end_ts"].dropna())))
-        alloc = np.zeros(len(g))
-        for i in range(len(boundaries) - 1):
-            seg_start = boundaries[i]
-            seg_end = boundaries[i + 1]
-            seg_len = (seg_end - seg_start).total_seconds()
-            if seg_len <= 0:
-                continue
-            active = g[(g["start_ts"] < seg_end) & (g["end_ts"] > seg_start)]
-            if len(active) > 0:
-                share = seg_len / len(active)
-                for idx in active.index:
-                    alloc[idx] += share
-        g["productive_seconds"] = alloc
-        out.append(g)
-    result = pd.concat(out, ignore_index=True) if out else events.assign(productive_seconds=events["duration_seconds"].clip(lower=0))
-    st.write(f"⏱ overlap_adjust: {len(events)} events in {time.time()-t0:.2f}s")
+    if rule == "count_full":
+        # Overlaps are not split: productive time is just the clipped duration, no sort or sweep
+        events = events.copy(deep=False)
+        events["productive_seconds"] = np.clip(events["duration_seconds"].values, 0, None)
+        _record("overlap_adjust", len(events), t0)
+        return events
+    # compute_kpis precomputes the UTC ns columns; standalone callers get them derived here
+    starts = events["start_ns"].to_numpy() if "start_ns" in events else _utc_ns(events["start_ts"])
+    ends = events["end_ns"].to_numpy() if "end_ns" in events else _utc_ns(events["end_ts"])
+    # Sort once by (agent, start) so each agent is one contiguous block of plain array slices
+    codes = pd.factorize(events["agent"])[0]
+    order = np.lexsort((starts, codes))
+    order = order[codes[order] >= 0]
+    offsets = np.append(np.flatnonzero(np.diff(codes[order], prepend=-1)), len(order))
+    s_sorted, e_sorted = starts[order], ends[order]
+    if HAVE_NUMBA:
+        alloc_sorted = _split_time_kernel(s_sorted, e_sorted, offsets)
+    else:
+        alloc_sorted = np.empty(len(order))
+        for lo, hi in zip(offsets[:-1], offsets[1:]):
+            alloc_sorted[lo:hi] = _split_time_alloc(s_sorted[lo:hi], e_sorted[lo:hi])
+    # Scattered back into one preallocated column; the frame itself is only shallow-copied
+    alloc = np.zeros(len(events))
+    alloc[order] = alloc_sorted
+    result = events.copy(deep=False)
+    result["productive_seconds"] = alloc
+    _record("overlap_adjust", len(events), t0)
     return result
 
 # ---------- KPI computation ----------
-def compute_kpis(df_tickets, df_calls, df_schedule, settings, tz_name, team_field="team"):
-    t0 = time.time()
-    st.write("🚀 Starting KPI computation...")
+def _sort_by_label(df, by):
+    # Categorical columns sort by label, not by the (first-seen) category order
+    key = lambda s: s.astype(object) if isinstance(s.dtype, pd.CategoricalDtype) else s
+    return df.sort_values(by, key=key, ignore_index=True)
+
+def _sum_count(grouped, engine=None):
+    # The numba engine pays off on large event tables, but its first call spends seconds compiling
+    if engine == "numba" and HAVE_NUMBA:
+        try:
+            total = grouped.sum(engine="numba", engine_kwargs={"nogil": True, "parallel": False})
+            return pd.DataFrame({"sum": total.astype("float32"), "count": grouped.count()}).reset_index()
+        except (NotImplementedError, TypeError, ValueError) as e:
+            st.write(f"[compute] numba groupby unavailable, using the default engine: {e}")
+    return grouped.agg(["sum","count"]).reset_index()
 
+def _labels(s):
+    # A categorical keeps its declared categories; anything else contributes its observed values
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        return s.cat.categories
+    return pd.Index(s.dropna().unique())
+
+def prepare_events(df_tickets, df_calls, settings, tz_name, team_field="team"):
+    # Everything here depends only on the uploads + timezone, not on shift or overlap settings,
+    # so the app can cache the event table separately from the KPIs derived from it
+    t0 = time.time()
     df_t = normalize_tickets(df_tickets, settings, tz_name)
     df_c = normalize_calls(df_calls, settings, tz_name)
 
-    mapping = load_category_mapping("config/category_mapping.json")
-    df_t = apply_category_mapping(df_t, settings.ticket_columns["category"], mapping)
-    df_c = apply_category_mapping(df_c, settings.call_columns["category"], mapping)
+    mapping, reverse_map = load_category_mappings("config/category_mapping.json")
+    df_t = apply_category_mapping(df_t, settings.ticket_columns["category"], mapping, reverse_map)
+    df_c = apply_category_mapping(df_c, settings.call_columns["category"], mapping, reverse_map)
 
     events_t = df_t.rename(columns={
         settings.ticket_columns["agent"]: "agent",
@@ -133,7 +367,199 @@ def compute_kpis(df_tickets, df_calls, df_schedule, settings, tz_name, team_fiel
     events_c["source"] = "Call"
     events_c["team"] = df_c[team_field] if team_field in df_c.columns else None
 
-    events = pd.concat([
-        events_t[["agent","start_ts","end_ts","duration_seconds","category_mapped","source","team"]],
-        events_c[["agent","start_ts","end_ts","duration_seconds","category_mapped","source","team"]]
-    ], ignore_index=True).dropna(sub
+    cols = ["agent","start_ts","end_ts","duration_seconds","category_mapped","source","team"]
+    events_t, events_c = events_t[cols], events_c[cols]
+    # Matching dtypes on both sides let concat reuse the blocks instead of upcasting to object.
+    # Low-cardinality labels as shared categoricals: groupby/merge hash integer codes, not strings
+    for c in ("agent","team","source","category_mapped"):
+        cats = _labels(events_t[c]).union(_labels(events_c[c]))
+        dtype = pd.CategoricalDtype(categories=cats)
+        events_t[c] = events_t[c].astype(dtype)
+        events_c[c] = events_c[c].astype(dtype)
+    for d in (events_t, events_c):
+        d["duration_seconds"] = d["duration_seconds"].astype("float32")
+    events = pd.concat([events_t, events_c], ignore_index=True, copy=False)
+    # One validity mask instead of dropna(): the usual all-valid case keeps the concatenated blocks as-is.
+    # The (agent, start) ordering is a single lexsort inside overlap_adjust
+    valid = (events["agent"].notna() & events["start_ts"].notna() & events["end_ts"].notna()).to_numpy()
+    if not valid.all():
+        events = events.take(np.flatnonzero(valid)).reset_index(drop=True)
+    if events.empty:
+        return events
+    # Uploads may carry different offsets (e.g. one export in UTC); put every event in the app timezone
+    for c in ("start_ts","end_ts"):
+        events[c] = pd.to_datetime(events[c], utc=True).dt.tz_convert(tz_name).dt.as_unit("ns")
+    # UTC int64 ns once: overlap split, shift clipping and date/hour bucketing all work on these
+    events["start_ns"] = events["start_ts"].values.view("i8")
+    events["end_ns"] = events["end_ts"].values.view("i8")
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("events: %d rows, %.2f MB", len(events), events.memory_usage(deep=True).sum() / 1e6)
+    _record("prepare_events", len(events), t0)
+    return events
+
+def compute_kpis(df_tickets, df_calls, df_schedule, settings, tz_name, team_field="team"):
+    log.debug("Starting KPI computation")
+    with timing_run():
+        events = prepare_events(df_tickets, df_calls, settings, tz_name, team_field=team_field)
+        return compute_kpis_from_events(events, df_schedule, settings, tz_name, team_field=team_field)
+
+def compute_kpis_from_events(events, df_schedule, settings, tz_name, team_field="team"):
+    if _run_timings.get() is None:
+        with timing_run():
+            return compute_kpis_from_events(events, df_schedule, settings, tz_name, team_field=team_field)
+    t0 = time.time()
+    if events.empty:
+        st.write("ℹ️ No ticket or call events to compute KPIs from")
+        return (pd.DataFrame(columns=["agent","date","team","productive_seconds","scheduled_seconds","utilization_pct","idle_seconds"]),
+                pd.DataFrame(columns=["category_mapped","source","avg_handle_seconds"]),
+                pd.DataFrame(columns=["agent","date","hour","team","productive_seconds"]))
+
+    adjusted = overlap_adjust(events, settings.overlap_rule)
+    # Local calendar day and hour by integer division of wall-clock ns (no per-row date objects)
+    local_ns = adjusted["start_ts"].dt.tz_localize(None).values.view("i8")
+    adjusted["date"] = (local_ns // NS_PER_DAY).astype("datetime64[D]")
+    adjusted["hour"] = (local_ns // NS_PER_HOUR % 24).astype("int8")
+
+    # Schedule: uploaded file or default shift per agent per active day
+    if df_schedule is None or df_schedule.empty:
+        df_s = build_default_schedule(adjusted["agent"], adjusted["date"], adjusted["team"],
+                                      settings.default_shift_start, settings.default_shift_end, settings)
+    else:
+        df_s = normalize_schedule(df_schedule, settings)
+    df_s = df_s.dropna(subset=[settings.schedule_columns["date"]])
+
+    date_str = pd.to_datetime(df_s[settings.schedule_columns["date"]]).dt.strftime("%Y-%m-%d")
+    # Accept HH:MM and HH:MM:SS (spreadsheet exports) shift times
+    ss = df_s[settings.schedule_columns["shift_start"]].astype(str).str.replace(r"^(\d{1,2}:\d{2})$", r"\1:00", regex=True)
+    se = df_s[settings.schedule_columns["shift_end"]].astype(str).str.replace(r"^(\d{1,2}:\d{2})$", r"\1:00", regex=True)
+    schedule = pd.DataFrame({
+        "agent": df_s[settings.schedule_columns["agent"]].values,
+        "date": pd.to_datetime(date_str).values.astype("datetime64[D]"),
+        "shift_start": pd.to_datetime(date_str + " " + ss, format="%Y-%m-%d %H:%M:%S", errors="coerce")
+                         .dt.tz_localize(tz_name, ambiguous="NaT", nonexistent="NaT"),
+        "shift_end": pd.to_datetime(date_str + " " + se, format="%Y-%m-%d %H:%M:%S", errors="coerce")
+                       .dt.tz_localize(tz_name, ambiguous="NaT", nonexistent="NaT"),
+        "team": df_s[team_field].values if team_field in df_s.columns else None,
+    })
+    bad_shifts = schedule["shift_start"].isna() | schedule["shift_end"].isna()
+    if bad_shifts.any():
+        st.write(f"⚠️ {int(bad_shifts.sum())} schedule rows have unparseable shift times and count as unscheduled")
+    # Schedules without a team column inherit the agent's team from the activity logs
+    team_map = adjusted.dropna(subset=["team"]).drop_duplicates("agent").set_index("agent")["team"]
+    schedule["team"] = schedule["team"].where(schedule["team"].notna(), schedule["agent"].map(team_map).astype(object))
+    # Share categories with the events so the merges below join on codes
+    for c in ("agent","team"):
+        cats = adjusted[c].cat.categories.union(pd.Index(schedule[c].dropna().unique()))
+        dtype = pd.CategoricalDtype(categories=cats)
+        adjusted[c] = adjusted[c].astype(dtype)
+        schedule[c] = schedule[c].astype(dtype)
+    schedule["scheduled_seconds"] = (schedule["shift_end"] - schedule["shift_start"]).dt.total_seconds().fillna(0).clip(lower=0)
+
+    # Clip each event to its shift window; days without a shift keep the full event
+    merged = adjusted.merge(
+        schedule[["agent","date","shift_start","shift_end"]]
+            .drop_duplicates(["agent","date"])
+            .rename(columns={"shift_start": "sched_start", "shift_end": "sched_end"}),
+        on=["agent","date"], how="left"
+    )
+    start_ns = merged["start_ns"].to_numpy()
+    end_ns = merged["end_ns"].to_numpy()
+    # A missing shift is NaT (int64 min), which np.maximum ignores; the end bound needs an explicit mask
+    clip_start = np.maximum(start_ns, _utc_ns(merged["sched_start"]))
+    clip_end = np.where(merged["sched_end"].isna().to_numpy(), end_ns, np.minimum(end_ns, _utc_ns(merged["sched_end"])))
+    clipped = np.empty(len(merged), dtype=np.float64)
+    np.subtract(clip_end, clip_start, out=clipped)
+    clipped *= 1e-9
+    np.clip(clipped, 0, None, out=clipped)
+    merged["clipped_duration"] = clipped
+    # KPI seconds are bounded by a day and shown to the minute: float32 halves the bytes the groupbys move
+    merged["productive_seconds"] = np.minimum(merged["productive_seconds"], merged["clipped_duration"]).astype("float32")
+    schedule["scheduled_seconds"] = schedule["scheduled_seconds"].astype("float32")
+
+    # One hash pass over the event rows; daily, category and heatmap outputs regroup this small base.
+    # Narrow keys (int8 hour, datetime64[D] local date, categorical labels) keep the hash table small
+    grouped = merged.groupby(["agent","date","hour","team","category_mapped","source"],
+                             dropna=False, observed=True, sort=False)["productive_seconds"]
+    base = _sum_count(grouped, settings.groupby_engine)
+
+    # Daily per-agent KPIs
+    daily_prod = base.groupby(["agent","date","team"], dropna=False, observed=True, sort=False)["sum"].sum().reset_index(name="productive_seconds")
+    sched_seconds = schedule.groupby(["agent","date","team"], dropna=False, observed=True, sort=False)["scheduled_seconds"].sum().reset_index()
+    # datetime64 dates + shared-category agent/team: the join hashes integers, not date/str objects
+    keys = ["agent","date","team"]
+    daily = daily_prod.set_index(keys).join(sched_seconds.set_index(keys)[["scheduled_seconds"]], how="left").reset_index()
+    daily["scheduled_seconds"] = daily["scheduled_seconds"].fillna(0)
+    prod = daily["productive_seconds"].to_numpy(dtype=np.float64)
+    sched = daily["scheduled_seconds"].to_numpy(dtype=np.float64)
+    # Divide only where a shift exists: no 0/0 warnings, unscheduled days stay NaN
+    util = np.full_like(prod, np.nan)
+    np.divide(prod, sched, out=util, where=sched > 0)
+    util *= 100
+    daily["utilization_pct"] = util
+    idle = sched - prod
+    np.clip(idle, 0, None, out=idle)
+    daily["idle_seconds"] = idle.astype("float32")
+
+    # Average handling time by category
+    cat_aht = base.groupby(["category_mapped","source"], dropna=False, observed=True, sort=False)[["sum","count"]].sum().reset_index()
+    cat_aht["avg_handle_seconds"] = (cat_aht["sum"] / cat_aht["count"]).astype("float32")
+    cat_aht = cat_aht[["category_mapped","source","avg_handle_seconds"]]
+
+    # Team heatmap by day/hour
+    heatmap = base.groupby(["agent","date","hour","team"], dropna=False, observed=True, sort=False)["sum"].sum().reset_index(name="productive_seconds")
+
+    # The groupbys run unsorted; only the small result tables are put in (agent, date) order for
+    # display and export
+    daily = _sort_by_label(daily, ["agent","date","team"])
+    heatmap = _sort_by_label(heatmap, ["agent","date","hour","team"])
+
+    # float32 is for the aggregation passes only; results go out as float64 seconds rounded to the
+    # millisecond so tables and exports don't show float32 noise (e.g. 5.9259257)
+    for out, cols in ((daily, ["productive_seconds","scheduled_seconds","idle_seconds"]),
+                      (cat_aht, ["avg_handle_seconds"]), (heatmap, ["productive_seconds"])):
+        out[cols] = out[cols].astype("float64").round(3)
+
+    _record("compute_kpis total", len(merged), t0)
+    # One UI write for all stage timings instead of a frontend round-trip per stage
+    st.write(pd.DataFrame.from_dict(_run_timings.get(), orient="index"))
+    return daily, cat_aht, heatmap
+
+
+if __name__ == "__main__":
+    # Regression check (`python compute.py`): the split_time sweeps must match the original
+    # per-segment allocation, including zero-length and inverted windows.
+    def _split_time_reference(starts, ends):
+        boundaries = np.unique(np.concatenate([starts, ends]))
+        alloc = np.zeros(len(starts))
+        for seg_start, seg_end in zip(boundaries[:-1], boundaries[1:]):
+            active = np.flatnonzero((starts < seg_end) & (ends > seg_start))
+            if len(active):
+                alloc[active] += (seg_end - seg_start) * 1e-9 / len(active)
+        return alloc
+
+    rng = np.random.default_rng(0)
+    n = 300
+    for _ in range(20):
+        starts = rng.integers(0, 5 * 3600, n) * 10**9
+        ends = starts + rng.integers(-600, 3600, n) * 10**9
+        ends[:10] = starts[:10]
+        halves = [slice(0, n // 2), slice(n // 2, n)]
+        expected = np.concatenate([_split_time_reference(starts[h], ends[h]) for h in halves])
+        got = np.concatenate([_split_time_alloc(starts[h], ends[h]) for h in halves])
+        assert np.allclose(got, expected, rtol=0, atol=1e-6), "NumPy sweep diverged from reference"
+        if HAVE_NUMBA:
+            got = _split_time_kernel(starts, ends, np.array([0, n // 2, n]))
+            assert np.allclose(got, expected, rtol=0, atol=1e-6), "Numba sweep diverged from reference"
+    print(f"split_time sweep matches the per-segment reference (numba={'on' if HAVE_NUMBA else 'off'})")
+
+    # Category mapping: missing or blank labels (a blank CSV column reads as all <NA>) map to "Other"
+    mapping = {"Incidents": ["incident"], "Calls": []}
+    for raw, expected in (
+        (["Incident", "INCIDENT", "Calls", "weird", None], ["Incidents", "Incidents", "Calls", "Other", "Other"]),
+        ([None, None], ["Other", "Other"]),
+        (pd.array([pd.NA, pd.NA], dtype="string[pyarrow]"), ["Other", "Other"]),
+        ([], []),
+    ):
+        got = apply_category_mapping(pd.DataFrame({"category": raw}), "category", mapping)["category_mapped"].tolist()
+        assert got == expected, f"category mapping {list(raw)} -> {got}, expected {expected}"
+    print("category mapping handles canonical, unknown and all-missing labels")
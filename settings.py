@@ -1,5 +1,6 @@
 from dataclasses import dataclass
 from datetime import time
+from typing import Optional
 
 @dataclass
 class DefaultSettings:
@@ -7,6 +8,11 @@ class DefaultSettings:
     default_shift_end: time = time(18, 0)
     overlap_rule: str = "split_time"
     timezone: str = "Asia/Kolkata"
+    # Timestamp parsing: pd.to_datetime format (None = infer per value), unit for numeric epoch columns
+    ts_format: Optional[str] = "ISO8601"
+    epoch_unit: str = "s"
+    # "numba" JIT-compiles the event-level groupby sum (needs numba); None keeps pandas' Cython path
+    groupby_engine: Optional[str] = None
 
     ticket_columns = {
         "agent": "agent",